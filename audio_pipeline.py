@@ -3,7 +3,7 @@ Audio AI Pipeline (Offline/Free Version)
 ----------------------------------------
 Performs:
 1. Audio preprocessing 
-2. Speech-to-text transcription 
+2. Speech-to-text transcription (Vosk offline, or Google Web Speech + Sphinx)
 3. Multi-factor confidence scoring (API confidence + SNR + perplexity)
 4. PII redaction (regex + spaCy NER)
 5. Text summarization
@@ -12,92 +12,200 @@ Performs:
 """
 
 import os
+import shutil
 import re
-import json
+import atexit
+import bisect
 import datetime
-import librosa
+import functools
+import hashlib
 import numpy as np
+import orjson
+import soundfile as sf
 from dotenv import load_dotenv
 import speech_recognition as sr
 from gtts import gTTS
-import spacy
 from pydub import AudioSegment, effects
 import noisereduce as nr
 import time
-
-# Load spaCy model
-nlp = spacy.load("en_core_web_sm")
+from concurrent.futures import ThreadPoolExecutor
+
+# spaCy model is loaded on first use (only tok2vec + ner are needed for PERSON redaction)
+@functools.lru_cache(maxsize=1)
+def _get_nlp():
+    import spacy
+    return spacy.load("en_core_web_sm", disable=["tagger", "parser", "attribute_ruler", "lemmatizer"])
+
+# Single background worker used to overlap spaCy NER with the regex PII scan
+@functools.lru_cache(maxsize=1)
+def _get_executor():
+    return ThreadPoolExecutor(max_workers=1)
+
+# Known-name matcher only needs a tokenizer, so it is built on a blank pipeline
+@functools.lru_cache(maxsize=8)
+def _get_name_matcher(known_names: tuple):
+    import spacy
+    from spacy.matcher import PhraseMatcher
+    blank = spacy.blank("en")
+    matcher = PhraseMatcher(blank.vocab, attr="LOWER")
+    matcher.add("PERSON", [blank.make_doc(n) for n in known_names])
+    return blank, matcher
 
 # ------------------ STEP 1: ENVIRONMENT SETUP ------------------
 def load_env(env_path: str = ".env") -> None:
     load_dotenv(env_path)
 
 # ------------------ STEP 2: PREPROCESS AUDIO ------------------
+# Peak int16 level after normalization, same 0.1 dB headroom as pydub's effects.normalize
+_NORMALIZE_PEAK = 32767 * 10 ** (-0.1 / 20)
+
 def preprocess_audio(input_path, output_path):
-    audio = AudioSegment.from_file(input_path)
-    audio = effects.normalize(audio)
+    """Normalize input audio and write it as WAV.
+
+    Returns the WAV path plus the decoded int16 samples and sample rate, so
+    later steps can work on the buffer without decoding the file again.
+    """
     output_wav_path = output_path.replace(".mp3", ".wav")
-    audio.export(output_wav_path, format="wav")
-    return output_wav_path
+    try:
+        data, sample_rate = sf.read(input_path, dtype="int16")
+    except sf.LibsndfileError:
+        # Formats libsndfile can't decode still go through pydub/ffmpeg
+        audio = AudioSegment.from_file(input_path)
+        audio = effects.normalize(audio.set_sample_width(2))
+        audio.export(output_wav_path, format="wav")
+        data = np.array(audio.get_array_of_samples(), dtype=np.int16)
+        if audio.channels > 1:
+            data = data.reshape(-1, audio.channels)
+        return output_wav_path, data, audio.frame_rate
+
+    peak = max(int(data.max()), -int(data.min())) if data.size else 0
+    if peak > 0:
+        # Scale in place; the gain keeps the peak below 32767 so the cast cannot overflow
+        np.multiply(data, _NORMALIZE_PEAK / peak, out=data, casting="unsafe")
+    sf.write(output_wav_path, data, sample_rate, subtype="PCM_16")
+    return output_wav_path, data, sample_rate
 
 # ------------------ STEP 3: SPEECH-TO-TEXT ------------------
-def transcribe_audio(audio_path: str, max_retries=3):
-    recognizer = sr.Recognizer()
+@functools.lru_cache(maxsize=1)
+def _get_recognizer():
+    return sr.Recognizer()
+
+# Vosk is optional and only imported when a model directory is configured
+@functools.lru_cache(maxsize=1)
+def _get_vosk_model(model_path: str):
+    from vosk import Model, SetLogLevel
+    SetLogLevel(-1)
+    return Model(model_path)
+
+def _transcribe_vosk(audio_data, model_path: str):
+    from vosk import KaldiRecognizer
+    rec = KaldiRecognizer(_get_vosk_model(model_path), 16000)
+    rec.SetWords(True)
+    rec.AcceptWaveform(audio_data.get_raw_data(convert_rate=16000, convert_width=2))
+    result = orjson.loads(rec.FinalResult())
+    words_info = result.get("result", [])
+    words = [w["word"] for w in words_info]
+    confs = np.array([w["conf"] for w in words_info], dtype=np.float32)
+    return result.get("text", ""), words, confs
+
+def transcribe_audio(audio_path: str, max_retries=3, vosk_model_path=None):
+    """Transcribe a WAV file.
+
+    Uses the offline Vosk model at vosk_model_path when given (with real
+    per-word confidences), otherwise Google Web Speech with Sphinx fallback.
+    Returns (transcript, words, word_confidences, confidence), where
+    word_confidences is a float32 array aligned with the words list.
+    """
+    recognizer = _get_recognizer()
+    # Read the WAV once; every Google retry and the Sphinx fallback reuse it
+    try:
+        with sr.AudioFile(audio_path) as source:
+            audio_data = recognizer.record(source)
+    except Exception as e:
+        print(f"⚠ Unexpected error during transcription: {e}")
+        return "", [], np.empty(0, dtype=np.float32), 0.0
+
+    if vosk_model_path:
+        try:
+            transcript, words, confs = _transcribe_vosk(audio_data, vosk_model_path)
+            if not words:
+                print("⚠ Could not understand audio, returning empty transcript.")
+                return "", [], np.empty(0, dtype=np.float32), 0.0
+            return transcript, words, confs, float(confs.mean())
+        except Exception as e:
+            print(f"⚠ Vosk transcription failed, falling back to Google: {e}")
+
     attempts = 0
     while attempts < max_retries:
         try:
-            with sr.AudioFile(audio_path) as source:
-                audio_data = recognizer.record(source)
             transcript = recognizer.recognize_google(audio_data)
             confidence = 0.85
-            return transcript, [{"word": w, "confidence": confidence} for w in transcript.split()], confidence
+            words = transcript.split()
+            return transcript, words, np.full(len(words), confidence, dtype=np.float32), confidence
         except sr.UnknownValueError:
             print("⚠ Could not understand audio, returning empty transcript.")
-            return "", [], 0.0
+            return "", [], np.empty(0, dtype=np.float32), 0.0
         except sr.RequestError as e:
             print(f"⚠ API request failed (attempt {attempts+1}/{max_retries}): {e}")
             attempts += 1
             time.sleep(1)
         except Exception as e:
             print(f"⚠ Unexpected error during transcription: {e}")
-            return "", [], 0.0
+            return "", [], np.empty(0, dtype=np.float32), 0.0
 
     # Fallback to offline Sphinx
     print("ℹ Falling back to offline Sphinx transcription...")
     try:
-        with sr.AudioFile(audio_path) as source:
-            audio_data = recognizer.record(source)
         transcript = recognizer.recognize_sphinx(audio_data)
         confidence = 0.7
-        return transcript, [{"word": w, "confidence": confidence} for w in transcript.split()], confidence
+        words = transcript.split()
+        return transcript, words, np.full(len(words), confidence, dtype=np.float32), confidence
     except Exception as e:
         print(f"❌ Both Google and Sphinx transcription failed: {e}")
-        return "", [], 0.0
+        return "", [], np.empty(0, dtype=np.float32), 0.0
 
 # ------------------ STEP 4: CONFIDENCE ANALYSIS ------------------
-def calculate_snr(audio_path: str) -> float:
-    y, sr = librosa.load(audio_path, sr=16000)
-    signal_power = np.mean(y**2)
-    noise_power = np.var(y)
-    return 10 * np.log10(signal_power / noise_power) if noise_power > 0 else 50.0
-
-def calculate_perplexity(word_confidences):
-    if not word_confidences:
+# Samples per chunk when accumulating SNR sums in int64
+_SNR_CHUNK = 1 << 16
+
+def calculate_snr(y: np.ndarray) -> float:
+    # Works on the int16 buffer from preprocess_audio. The ratio is independent of
+    # sample rate and scale, so channels are summed (not averaged) to stay integer.
+    if y.ndim > 1:
+        y = y.sum(axis=1, dtype=np.int32)
+    n = y.size
+    if n == 0:
+        return 50.0
+    # Exact integer sums of y^2 and y; chunking bounds the widened int64 copy
+    sum_sq = 0
+    total = 0
+    for start in range(0, n, _SNR_CHUNK):
+        chunk = y[start:start + _SNR_CHUNK].astype(np.int64)
+        sum_sq += int(chunk @ chunk)
+        total += int(chunk.sum())
+    # signal/noise = E[y^2] / (E[y^2] - E[y]^2) = n*sum_sq / (n*sum_sq - total^2)
+    noise = n * sum_sq - total * total
+    return 10 * np.log10(n * sum_sq / noise) if noise > 0 else 50.0
+
+def calculate_perplexity(word_confidences: np.ndarray):
+    if word_confidences.size == 0:
         return float("inf")
-    avg_conf = np.mean(word_confidences)
+    avg_conf = float(word_confidences.mean())
     return 1.0 / avg_conf
 
-def multi_factor_confidence(api_conf, snr, perplexity):
-    snr_norm = min(max((snr - 10) / 20, 0), 1)
-    perplexity_norm = max(1 - (perplexity - 1), 0)
+def multi_factor_confidence_batch(api_conf, snr, perplexity):
+    """Score arrays of per-transcript values; returns (combined, labels) arrays."""
+    api_conf = np.asarray(api_conf, dtype=np.float64)
+    snr_norm = np.clip((np.asarray(snr, dtype=np.float64) - 10) / 20, 0, 1)
+    perplexity_norm = np.maximum(1 - (np.asarray(perplexity, dtype=np.float64) - 1), 0)
     combined = 0.5 * api_conf + 0.3 * snr_norm + 0.2 * perplexity_norm
-    if combined > 0.85:
-        label = "HIGH"
-    elif combined > 0.7:
-        label = "MEDIUM"
-    else:
-        label = "LOW"
-    return combined, label
+    labels = np.where(combined > 0.85, "HIGH", np.where(combined > 0.7, "MEDIUM", "LOW"))
+    return combined, labels
+
+def multi_factor_confidence(api_conf, snr, perplexity):
+    # Single transcript goes through the batch scorer so weights and thresholds live in one place
+    combined, labels = multi_factor_confidence_batch([api_conf], [snr], [perplexity])
+    return float(combined[0]), str(labels[0])
 
 # ------------------ STEP 5: PII REDACTION ------------------
 _NUMBER_WORDS_MAP = {
@@ -105,47 +213,144 @@ _NUMBER_WORDS_MAP = {
     "six":"6","seven":"7","eight":"8","nine":"9","ten":"10"
 }
 
+_DIGIT_RE = re.compile(
+    r"\b(" + "|".join(sorted(_NUMBER_WORDS_MAP, key=len, reverse=True)) + r")\b", re.IGNORECASE
+)
+
+@functools.lru_cache(maxsize=1024)
+def _convert_spoken_digits_with_offsets(text: str):
+    """
+    Convert spoken digits and record where each replacement landed, as
+    (conv_start, conv_end, orig_start, orig_end) tuples, so spans found in the
+    converted text can be mapped back onto the original.
+    """
+    parts = []
+    anchors = []
+    last = 0
+    conv_len = 0
+    for m in _DIGIT_RE.finditer(text):
+        digit = _NUMBER_WORDS_MAP[m.group(1).lower()]
+        conv_start = conv_len + (m.start() - last)
+        conv_len = conv_start + len(digit)
+        parts.append(text[last:m.start()])
+        parts.append(digit)
+        anchors.append((conv_start, conv_len, m.start(), m.end()))
+        last = m.end()
+    parts.append(text[last:])
+    return "".join(parts), tuple(anchors)
+
+def _to_original_offset(anchors, pos: int, is_end: bool) -> int:
+    i = bisect.bisect_right(anchors, (pos, float("inf"))) - 1
+    if i < 0:
+        return pos
+    conv_start, conv_end, orig_start, orig_end = anchors[i]
+    if pos >= conv_end:
+        return orig_end + (pos - conv_end)
+    if pos == conv_start or not is_end:
+        return orig_start
+    # An end offset inside a converted word covers the whole word
+    return orig_end
+
 def convert_spoken_digits_to_digits(text: str) -> str:
     """Convert spoken digit words to digits to help regex detect credit card numbers."""
-    tokens = re.split(r'(\W+)', text)  # keep separators
-    for i, tok in enumerate(tokens):
-        low = tok.lower().strip()
-        if low in _NUMBER_WORDS_MAP:
-            tokens[i] = _NUMBER_WORDS_MAP[low]
-    return "".join(tokens)
-
-def redact_pii(text: str):
+    return _convert_spoken_digits_with_offsets(text)[0]
+
+_PII_PATTERNS = {
+    "CREDIT_CARD": r"(?:\d[\s-]?){13,16}",
+    "PHONE": r"\b\d{3}[-.\s]?\d{3}[-.\s]?\d{4}\b",
+    "EMAIL": r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b"
+}
+# One alternation so the transcript is scanned once; m.lastgroup gives the label.
+# re.ASCII keeps \d, \s and \b identical to the Hyperscan prefilter below.
+_PII_RE = re.compile("|".join(f"(?P<{k}>{v})" for k, v in _PII_PATTERNS.items()), re.ASCII)
+# Cheap PERSON heuristic (Title-Case bigram) used when spaCy is skipped
+_PERSON_RE = re.compile(r"\b[A-Z][a-z]+\s+[A-Z][a-z]+\b")
+
+# Optional Hyperscan prefilter: one SIMD DFA pass tells us whether any PII pattern
+# occurs at all, so transcripts without PII never reach the backtracking regex
+@functools.lru_cache(maxsize=1)
+def _get_pii_prefilter():
+    try:
+        import hyperscan
+    except ImportError:
+        return None
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[pat.encode() for pat in _PII_PATTERNS.values()],
+        ids=list(range(len(_PII_PATTERNS))),
+        elements=len(_PII_PATTERNS),
+        flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(_PII_PATTERNS),
+    )
+    return db
+
+def _may_contain_pii(text: str) -> bool:
+    db = _get_pii_prefilter()
+    # Hyperscan classes are ASCII-only, so non-ASCII text always goes to re
+    if db is None or not text.isascii():
+        return True
+    hits = []
+    db.scan(text.encode(), match_event_handler=lambda id, start, end, flags, context: hits.append(id))
+    return bool(hits)
+
+def redact_pii(text: str, lazy_spacy: bool = False, known_names=(), known_names_only: bool = False):
     """
     Redact credit cards, phone numbers, emails, and PERSON names.
     Dates and locations (GPE) are not redacted.
+    Occurrences of known_names (matched case-insensitively) are always
+    redacted, in addition to the names NER finds. With known_names_only=True,
+    NER is skipped and names NOT in known_names will not be redacted.
+    With lazy_spacy=True, PERSON names are found with a Title-Case regex
+    instead of spaCy NER, so the model is never loaded.
     """
-    # Convert spoken digits to numbers
-    text_conv = convert_spoken_digits_to_digits(text)
-
-    redacted = text_conv
+    # Convert spoken digits to numbers; only the regex scan sees the converted text
+    text_conv, anchors = _convert_spoken_digits_with_offsets(text)
+
+    # PERSON names: known-name matcher merged with the regex fast path or spaCy NER.
+    # NER runs on a worker thread so it overlaps with the regex scan below.
+    name_spans = []
+    ner_future = None
+    if known_names:
+        blank, matcher = _get_name_matcher(tuple(known_names))
+        doc = blank.make_doc(text)
+        name_spans = [(doc[start:end].start_char, doc[start:end].end_char) for _, start, end in matcher(doc)]
+    if not (known_names and known_names_only):
+        if lazy_spacy:
+            name_spans.extend(m.span() for m in _PERSON_RE.finditer(text))
+        else:
+            ner_future = _get_executor().submit(lambda: _get_nlp()(text))
+
+    # Regex matches, mapped from text_conv back to offsets in the original text
+    spans = []
+    if _may_contain_pii(text_conv):
+        spans = [
+            (_to_original_offset(anchors, m.start(), False), _to_original_offset(anchors, m.end(), True), m.lastgroup)
+            for m in _PII_RE.finditer(text_conv)
+        ]
+
+    if ner_future is not None:
+        doc = ner_future.result()
+        name_spans.extend((ent.start_char, ent.end_char) for ent in doc.ents if ent.label_ == "PERSON")
+    spans.extend((start, end, "PERSON") for start, end in name_spans)
+
+    # Rebuild the original text once from sorted spans; overlapping spans merge into the earlier one
+    spans.sort(key=lambda span: (span[0], -span[1]))
     redactions = []
-
-    patterns = {
-        "CREDIT_CARD": r"(?:\d[\s-]?){13,16}",
-        "PHONE": r"\b\d{3}[-.\s]?\d{3}[-.\s]?\d{4}\b",
-        "EMAIL": r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b"
-    }
-
-    # Apply regex redactions
-    for label, pat in patterns.items():
-        for m in re.finditer(pat, redacted):
-            original = m.group(0)
-            if original not in [r.get("text") for r in redactions]:
-                redacted = redacted.replace(original, f"[REDACTED_{label}]")
-                redactions.append({"type": label, "text": original})
-
-    # spaCy NER only for PERSON
-    doc = nlp(text)
-    for ent in doc.ents:
-        if ent.label_ == "PERSON":
-            if ent.text not in [r.get("text") for r in redactions]:
-                redacted = redacted.replace(ent.text, "[REDACTED_PERSON]")
-                redactions.append({"type": "PERSON", "text": ent.text})
+    seen = set()
+    parts = []
+    last = 0
+    for start, end, label in spans:
+        if start < last:
+            last = max(last, end)
+            continue
+        original = text[start:end]
+        parts.append(text[last:start])
+        parts.append(f"[REDACTED_{label}]")
+        last = end
+        if original not in seen:
+            seen.add(original)
+            redactions.append({"type": label, "text": original})
+    parts.append(text[last:])
+    redacted = "".join(parts)
 
     return redacted, redactions
 
@@ -153,24 +358,46 @@ def redact_pii(text: str):
 
 # ------------------ STEP 6: SUMMARIZATION ------------------
 def summarize_text(text: str, max_sentences: int = 3) -> str:
-    sentences = text.split(". ")
+    if not text.strip():
+        # Nothing to summarize; also keeps a lone "." from reaching gTTS
+        return ""
+    # maxsplit stops scanning once the sentences we keep have been found
+    sentences = text.split(". ", max_sentences)
     return ". ".join(sentences[:max_sentences]).strip() + "."
 
 # ------------------ STEP 7: TEXT-TO-SPEECH ------------------
+_TTS_CACHE_DIR = ".tts_cache"
+
 def synthesize_speech(text: str, output_path: str) -> str:
     if not text.strip():
         # Avoid crash if transcript is empty
         with open(output_path, "wb") as f:
             pass
         return output_path
+    # Reuse audio for text we've already synthesized instead of calling gTTS again
+    cache_path = os.path.join(_TTS_CACHE_DIR, hashlib.blake2b(text.encode(), digest_size=16).hexdigest() + ".mp3")
+    if os.path.exists(cache_path):
+        shutil.copyfile(cache_path, output_path)
+        return output_path
     tts = gTTS(text)
     tts.save(output_path)
+    os.makedirs(_TTS_CACHE_DIR, exist_ok=True)
+    shutil.copyfile(output_path, cache_path)
     return output_path
 
 # ------------------ STEP 8: AUDIT LOGGING ------------------
+@functools.lru_cache(maxsize=None)
+def _get_log_file(log_path: str):
+    # One handle per log file, kept open across calls and closed at interpreter exit
+    f = open(log_path, "ab")
+    atexit.register(f.close)
+    return f
+
 def write_audit_log(log_data: dict, log_path: str) -> None:
-    with open(log_path, "a") as f:
-        f.write(json.dumps(log_data) + "\n")
+    f = _get_log_file(log_path)
+    f.write(orjson.dumps(log_data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE))
+    # Flush every record so the audit trail survives a crash or kill
+    f.flush()
 
 # ------------------ STEP 9: MAIN PIPELINE ------------------
 def main():
@@ -183,17 +410,19 @@ def main():
 
     print(f"Processing audio file: {input_audio}")
     try:
-        processed_audio = preprocess_audio(input_audio, "processed_audio.mp3")
+        processed_audio, samples, _ = preprocess_audio(input_audio, "processed_audio.mp3")
     except Exception as e:
         print(f"❌ Failed preprocessing audio: {e}")
         return
 
-    transcript, words, api_conf = transcribe_audio(processed_audio)
-    word_confidences = [w["confidence"] for w in words]
-    snr_val = calculate_snr(processed_audio)
+    transcript, words, word_confidences, api_conf = transcribe_audio(
+        processed_audio, vosk_model_path=os.getenv("VOSK_MODEL_PATH")
+    )
+    snr_val = calculate_snr(samples)
     perplexity_val = calculate_perplexity(word_confidences)
     combined, level = multi_factor_confidence(api_conf, snr_val, perplexity_val)
-    redacted, redactions = redact_pii(transcript)
+    known_names = [n.strip() for n in os.getenv("KNOWN_NAMES", "").split(",") if n.strip()]
+    redacted, redactions = redact_pii(transcript, known_names=known_names)
     summary = summarize_text(redacted)
     summary_audio = synthesize_speech(summary, "output_summary.mp3")
 